@@ -1,38 +1,117 @@
 import json
+import re
+import asyncio
+import argparse
 import openai
 import logging
 import backoff
-from typing import Dict, List, Tuple
+import diskcache
+import hashlib
+import tiktoken
+import time
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
-from collections import defaultdict
+from functools import lru_cache
 from humanloop import Humanloop
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 from textwrap import wrap
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-import smtplib
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def create_conversation_prompt(conversations: Dict) -> str:
-    formatted_convs = []
-    for conv_id, messages in conversations.items():
-        conv = [f"\nConversation {conv_id}:"]
-        for msg in messages:
-            conv.extend([
-                f"User ({msg['log_id']}): {msg['input']}", 
-                f"System: {msg['output']}\n"
-            ])
-        formatted_convs.append("\n".join(conv))
-    
-    prompt = """Analyze these customer service conversations. For each point, include SPECIFIC examples with their exact log_ids (format: log_XYZ):
+BATCH_MODEL = os.getenv("BATCH_MODEL", "gpt-4o-mini")
+FINAL_MODEL = os.getenv("FINAL_MODEL", "gpt-4o")
+
+_LOG_ID_RE = re.compile(r'log_[a-zA-Z0-9]+')
+
+_llm_cache = None
+LLM_CACHE_EXPIRE = 7 * 86400
+
+def get_llm_cache() -> diskcache.Cache:
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = diskcache.Cache(".llm_cache")
+    return _llm_cache
+
+def llm_cache_key(model: str, temperature: float, prompt: str) -> str:
+    return hashlib.sha256(f"{model}|{temperature}|{prompt}".encode()).hexdigest()
+
+_encoding = None
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(BATCH_MODEL)
+        except KeyError:
+            # Older tiktoken releases don't know newer model names; fall back to the gpt-4o encoding
+            _encoding = tiktoken.get_encoding("o200k_base")
+    return len(_encoding.encode(text))
+
+# Completion tokens reserved per request when metering TPM. Responses are not capped at this;
+# it is only an estimate of a typical batch summary.
+COMPLETION_TOKEN_ESTIMATE = int(os.getenv("COMPLETION_TOKEN_ESTIMATE", "1500"))
+
+# Token bucket metering requests and tokens per minute before each API call
+class RateLimiter:
+    def __init__(self, client):
+        self.client = client
+        self.max_rpm = None
+        self.max_tpm = None
+        self._configure_lock = asyncio.Lock()
+
+    async def _configure(self):
+        max_rpm = os.getenv("MAX_RPM")
+        max_tpm = os.getenv("MAX_TPM")
+        if not (max_rpm and max_tpm):
+            # Fire a 1-token probe and read the account limits off the response headers
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(
+                    model=BATCH_MODEL,
+                    messages=[{"role": "user", "content": "ping"}],
+                    max_tokens=1
+                )
+                max_rpm = max_rpm or raw.headers.get("x-ratelimit-limit-requests")
+                max_tpm = max_tpm or raw.headers.get("x-ratelimit-limit-tokens")
+            except Exception as e:
+                logger.error(f"Rate limit probe failed: {e}")
+        self.max_rpm = float(max_rpm or 500)
+        self.max_tpm = float(max_tpm or 10000)
+        self.available_request_capacity = self.max_rpm
+        self.available_token_capacity = self.max_tpm
+        self.last_update = time.monotonic()
+        print(f"Rate limiting to {self.max_rpm:.0f} RPM / {self.max_tpm:.0f} TPM")
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_request_capacity = min(self.max_rpm, self.available_request_capacity + elapsed * self.max_rpm / 60)
+        self.available_token_capacity = min(self.max_tpm, self.available_token_capacity + elapsed * self.max_tpm / 60)
+        self.last_update = now
+
+    async def acquire(self, prompt_tokens: int, completion_tokens: int = COMPLETION_TOKEN_ESTIMATE):
+        # Limits are only looked up once a call actually needs to be made, so all-cached runs never probe
+        if self.max_rpm is None:
+            async with self._configure_lock:
+                if self.max_rpm is None:
+                    await self._configure()
+        # OpenAI counts completion tokens against TPM too, so reserve an estimate for them.
+        # A single request larger than the bucket would never fit, so cap the reservation.
+        tokens = min(prompt_tokens + completion_tokens, self.max_tpm)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            request_wait = (1 - self.available_request_capacity) * 60 / self.max_rpm
+            token_wait = (tokens - self.available_token_capacity) * 60 / self.max_tpm
+            await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+CONVERSATION_PROMPT_HEADER = """Analyze these customer service conversations. For each point, include SPECIFIC examples with their exact log_ids (format: log_XYZ):
 
 1. Successful interactions
 2. User pain points/frustrations 
@@ -42,125 +121,462 @@ def create_conversation_prompt(conversations: Dict) -> str:
 IMPORTANT: Always reference specific log_ids when providing examples, not conversation numbers.
 
 Conversations:
-{}""".format("\n".join(formatted_convs))
-    
-    return prompt
+"""
+
+def create_conversation_prompt(conversations: Dict) -> str:
+    parts = [CONVERSATION_PROMPT_HEADER]
+    separator = "\n"
+    for conv_id, messages in conversations.items():
+        parts.append(f"{separator}Conversation {conv_id}:")
+        separator = "\n\n"
+        parts.extend(f"\nUser ({msg['log_id']}): {msg['input']}\nSystem: {msg['output']}\n" for msg in messages)
+    return ''.join(parts)
+
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "6000"))
+
+def conversation_tokens(conv_id: str, messages: List[Dict]) -> int:
+    # Token counts are cached on each log dict so re-packing or splitting a batch never re-encodes
+    total = count_tokens(f"\n\nConversation {conv_id}:")
+    for msg in messages:
+        if 'tokens' not in msg:
+            msg['tokens'] = count_tokens(f"\nUser ({msg['log_id']}): {msg['input']}\nSystem: {msg['output']}\n")
+        total += msg['tokens']
+    return total
+
+def pack_batches(conversations: Dict, batch_size: int) -> List[Dict]:
+    # Greedily fill each batch up to MAX_PROMPT_TOKENS, with batch_size as a hard ceiling
+    header_tokens = count_tokens(CONVERSATION_PROMPT_HEADER)
+    batches = []
+    current = {}
+    current_tokens = header_tokens
+    for conv_id, messages in conversations.items():
+        tokens = conversation_tokens(conv_id, messages)
+        if current and (current_tokens + tokens > MAX_PROMPT_TOKENS or len(current) >= batch_size):
+            batches.append(current)
+            current = {}
+            current_tokens = header_tokens
+        current[conv_id] = messages
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def is_retryable(e: Exception) -> bool:
+    # Only rate limits, server errors and dropped connections can succeed on a retry
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, openai.APIConnectionError)
 
 @backoff.on_exception(
    backoff.expo,
-   (openai.APIError, openai.RateLimitError),
-   max_tries=5
+   openai.APIError,
+   max_tries=5,
+   giveup=lambda e: not is_retryable(e)
 )
-def analyze_batch(conversations: Dict, client) -> Tuple[str, List[str]]:
+async def analyze_batch(conversations: Dict, client, sem: asyncio.Semaphore, limiter: RateLimiter, model: str = BATCH_MODEL) -> Tuple[List[str], List[str]]:
    try:
        print(f"\nAnalyzing batch of {len(conversations)} conversations...")
        prompt = create_conversation_prompt(conversations)
-       response = client.chat.completions.create(
-           model="gpt-4",
-           messages=[{"role": "user", "content": prompt}],
-           temperature=0,
-           timeout=30
-       )
+       cache = get_llm_cache()
+       key = llm_cache_key(model, 0, prompt)
+       if key in cache:
+           print("Using cached batch analysis")
+           return [cache[key]], []
+       async with sem:
+           await limiter.acquire(count_tokens(prompt))
+           response = await client.chat.completions.create(
+               model=model,
+               messages=[{"role": "user", "content": prompt}],
+               temperature=0,
+               timeout=30
+           )
+       content = response.choices[0].message.content
+       cache.set(key, content, expire=LLM_CACHE_EXPIRE)
        print("Batch analysis successful")
-       return response.choices[0].message.content, []
-   except (openai.Timeout, TimeoutError) as e:
+       return [content], []
+   except (openai.APITimeoutError, TimeoutError) as e:
        print(f"\nERROR: API timeout - splitting batch")
        logger.error(f"Timeout: {e}")
        items = list(conversations.items())
        mid = len(items) // 2
        if mid == 0:
-           return None, [f"Skipped conversation: {list(conversations.keys())[0]}"]
-       return batch_analyze(dict(items[:mid]), 1)[0], batch_analyze(dict(items[mid:]), 1)[0]
+           return [], [f"Skipped conversation: {list(conversations.keys())[0]}"]
+       # Each half retries on its own; a half that still fails is reported instead of
+       # escaping to this call's backoff, which would re-send the batch that timed out
+       summaries, errors = [], []
+       for result in await asyncio.gather(
+           analyze_batch(dict(items[:mid]), client, sem, limiter, model),
+           analyze_batch(dict(items[mid:]), client, sem, limiter, model),
+           return_exceptions=True
+       ):
+           if isinstance(result, BaseException):
+               logger.error(f"Split batch failed: {result}")
+               errors.append(f"Error processing batch: {str(result)}")
+               continue
+           summaries.extend(result[0])
+           errors.extend(result[1])
+       return summaries, errors
+   except openai.APIError:
+       # Let backoff see these so retryable errors are retried
+       raise
    except Exception as e:
        print(f"\nERROR: {str(e)}")
        logger.error(f"Unexpected error: {e}")
-       return None, [f"Error processing batch: {str(e)}"]
+       return [], [f"Error processing batch: {str(e)}"]
+
+async def run_batch_job(batches: List[Dict], client) -> Tuple[Dict[int, str], List[str]]:
+    cache = get_llm_cache()
+    results = {}
+    pending = {}
+    lines = []
+    for i, batch in enumerate(batches):
+        custom_id = f"batch_{i}"
+        prompt = create_conversation_prompt(batch)
+        key = llm_cache_key(BATCH_MODEL, 0, prompt)
+        if key in cache:
+            results[custom_id] = cache[key]
+            continue
+        pending[custom_id] = {"key": key, "log_ids": sorted(conversation_log_ids(batch))}
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": BATCH_MODEL,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0
+            }
+        }))
 
-def batch_analyze(conversations: Dict, batch_size: int = 5) -> Tuple[List[str], List[str]]:
-    print(f"\nStarting analysis of {len(conversations)} conversations in batches of {batch_size}")
-    client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-    summaries = []
     errors = []
-    
-    items = list(conversations.items())
-    for i in range(0, len(items), batch_size):
-        batch = dict(items[i:i + batch_size])
-        summary, batch_errors = analyze_batch(batch, client)
-        if summary:
-            print(f"Successfully processed batch {i//batch_size + 1}")
+    if results:
+        print(f"\nUsing cached analysis for {len(results)} of {len(batches)} batches")
+    if lines:
+        job_id = await submit_batch_job(lines, client)
+        job_results, errors = await finish_batch_job(client, {"id": job_id, "batches": pending})
+        results.update(job_results)
+
+    return {i: results[f"batch_{i}"] for i in range(len(batches)) if f"batch_{i}" in results}, errors
+
+async def submit_batch_job(lines: List[str], client) -> str:
+    print(f"\nSubmitting {len(lines)} batches to the OpenAI Batch API...")
+    input_file = await client.files.create(
+        file=("batch_input.jsonl", "\n".join(lines).encode()),
+        purpose="batch"
+    )
+    job = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return job.id
+
+@backoff.on_exception(
+   backoff.expo,
+   openai.APIError,
+   max_tries=5,
+   giveup=lambda e: not is_retryable(e)
+)
+async def retrieve_batch_job(client, job_id: str):
+    return await client.batches.retrieve(job_id)
+
+async def finish_batch_job(client, pending: Dict) -> Tuple[Dict[str, str], List[str]]:
+    # The job is recorded in the state file until its results are cached, so a run that dies
+    # while polling leaves it for the next run to resume instead of paying for it twice
+    update_state(pending_batch_job=pending)
+    poll_interval = int(os.getenv("BATCH_POLL_SECONDS", "60"))
+    job = await retrieve_batch_job(client, pending["id"])
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        print(f"Batch job {job.id} is {job.status}, checking again in {poll_interval}s")
+        await asyncio.sleep(poll_interval)
+        job = await retrieve_batch_job(client, job.id)
+
+    # Successful requests land in the output file and failed ones in the error file. An expired
+    # or cancelled job still has files for the requests it finished, so read them regardless.
+    results = {}
+    errors = []
+    if job.status != "completed":
+        print(f"Batch job {job.id} ended with status {job.status}, keeping the requests it completed")
+    failed = set()
+    for file_id in (job.output_file_id, job.error_file_id):
+        if not file_id:
+            continue
+        output = await client.files.content(file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                failed.add(record["custom_id"])
+                errors.append(f"Error processing {record['custom_id']}: {record.get('error') or response.get('body')}")
+                continue
+            results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+    cache = get_llm_cache()
+    for custom_id, batch in pending["batches"].items():
+        if custom_id in results:
+            cache.set(batch["key"], results[custom_id], expire=LLM_CACHE_EXPIRE)
+        elif custom_id not in failed:
+            errors.append(f"No result returned for {custom_id} by batch job {job.id} ({job.status})")
+    update_state(pending_batch_job=None)
+    return results, errors
+
+async def resume_pending_batch_job(client) -> Tuple[List[str], List[str], Set[str]]:
+    pending = load_state().get("pending_batch_job")
+    if not pending:
+        return [], [], set()
+    print(f"\nResuming batch job {pending['id']} left by a previous run")
+    results, errors = await finish_batch_job(client, pending)
+    summaries = []
+    log_ids = set()
+    for custom_id, batch in pending["batches"].items():
+        if custom_id in results:
+            summaries.append(results[custom_id])
+            log_ids.update(batch["log_ids"])
+    return summaries, errors, log_ids
+
+STATE_FILE = ".state.json"
+
+# Each fetch reaches this far back past the previous run's fetch so late-arriving logs and
+# conversations straddling the boundary are picked up; processed log IDs absorb the overlap
+FETCH_OVERLAP = timedelta(hours=1)
+
+def load_state() -> Dict:
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE, 'r') as f:
+        return json.load(f)
+
+def load_processed_log_ids() -> Set[str]:
+    return set(load_state().get("processed_log_ids", []))
+
+def fetch_start_date(now: datetime) -> datetime:
+    last_fetch = load_state().get("last_fetch_at")
+    if last_fetch is None:
+        return now - timedelta(days=1) - FETCH_OVERLAP
+    return datetime.fromisoformat(last_fetch) - FETCH_OVERLAP
+
+def fetch_watermark(conversations: Dict, processed: Set[str], fetched_at: datetime) -> datetime:
+    # A conversation that was not summarized (its batch failed or the job expired) has to be
+    # fetched again, so the next run must start no later than its first message
+    unprocessed = [
+        messages[0]['created_at'] for messages in conversations.values()
+        if not {msg['log_id'] for msg in messages} <= processed
+    ]
+    return min(unprocessed, default=fetched_at)
+
+def update_state(**fields):
+    state = load_state()
+    state.update(fields)
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f)
+
+def save_state(log_ids: Set[str], fetched_at: datetime):
+    update_state(processed_log_ids=sorted(log_ids), last_fetch_at=fetched_at.isoformat())
+
+def conversation_log_ids(conversations: Dict) -> Set[str]:
+    return {msg['log_id'] for messages in conversations.values() for msg in messages}
+
+async def batch_analyze(conversations: Dict, batch_size: int = 5, interactive: bool = False) -> Tuple[List[str], List[str], Set[str]]:
+    # Conversations fully covered by an earlier run are skipped; the returned log ID set is
+    # everything that is now summarized, so the state file only tracks the current window.
+    client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    # A batch job from a run that died while polling is already paid for; collect it first
+    summaries, errors, processed = await resume_pending_batch_job(client)
+    already_processed = load_processed_log_ids() | processed
+    pending = {}
+    for conv_id, messages in conversations.items():
+        log_ids = {msg['log_id'] for msg in messages}
+        if log_ids <= already_processed:
+            processed |= log_ids
+        else:
+            pending[conv_id] = messages
+    if len(pending) < len(conversations):
+        print(f"\nSkipping {len(conversations) - len(pending)} conversations summarized in a previous run")
+    conversations = pending
+
+    print(f"\nStarting analysis of {len(conversations)} conversations in batches of up to {batch_size} ({MAX_PROMPT_TOKENS} prompt tokens)")
+    batches = pack_batches(conversations, batch_size)
+    if not batches:
+        return summaries, errors, processed
+
+    if not interactive:
+        results, job_errors = await run_batch_job(batches, client)
+        errors.extend(job_errors)
+        for i, summary in sorted(results.items()):
             summaries.append(summary)
+            processed |= conversation_log_ids(batches[i])
+        print(f"\nAnalysis complete. Generated {len(summaries)} summaries with {len(errors)} errors")
+        return summaries, errors, processed
+
+    sem = asyncio.Semaphore(int(os.getenv("OPENAI_CONCURRENCY", "8")))
+    limiter = RateLimiter(client)
+    tasks = [analyze_batch(batch, client, sem, limiter) for batch in batches]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for batch_num, (batch, result) in enumerate(zip(batches, results), 1):
+        if isinstance(result, BaseException):
+            print(f"Encountered errors in batch {batch_num}")
+            logger.error(f"Batch {batch_num} failed: {result}")
+            errors.append(f"Error processing batch: {str(result)}")
+            continue
+        batch_summaries, batch_errors = result
+        if batch_summaries:
+            print(f"Successfully processed batch {batch_num}")
+            summaries.extend(batch_summaries)
         if batch_errors:
-            print(f"Encountered errors in batch {i//batch_size + 1}")
+            print(f"Encountered errors in batch {batch_num}")
+        elif batch_summaries:
+            processed |= conversation_log_ids(batch)
         errors.extend(batch_errors)
     
     print(f"\nAnalysis complete. Generated {len(summaries)} summaries with {len(errors)} errors")
-    return summaries, errors
-
-def get_production_logs(humanloop_client, file_id: str):
-    yesterday = datetime.now(timezone.utc) - timedelta(days=2)
-    logs = []
-    
-    print("Fetching logs from the last 24 hours...")
-    for log in humanloop_client.logs.list(file_id=file_id, start_date=yesterday):
+    return summaries, errors, processed
+
+def parse_created_at(value) -> datetime:
+    # The SDK normally hands back a datetime already; only fall back to parsing for strings
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+
+def iter_production_logs(humanloop_client, file_id: str, start_date: datetime) -> Iterator[Dict]:
+    print(f"Fetching logs since {start_date.isoformat(timespec='seconds')}...")
+    log_count = 0
+    for log in humanloop_client.logs.list(file_id=file_id, start_date=start_date):
         if log.source == 'production':
-            logs.append({
+            log_count += 1
+            yield {
                 'log_id': log.log_id,
-                'created_at': log.created_at,
+                'created_at': parse_created_at(log.created_at),
                 'user': log.user,
                 'input': log.inputs.get('user_message', ''),
                 'output': log.output
-            })
-    print(f"Found {len(logs)} production logs")
-    return logs
-
-def group_conversations(logs: List[Dict], hour_window: int = 1) -> Dict:
-    conversations = defaultdict(list)
-    sorted_logs = sorted(logs, key=lambda x: x['created_at'])
+            }
+    print(f"Found {log_count} production logs")
+
+def group_conversations(logs: Iterable[Dict], hour_window: int = 1) -> Dict:
+    conversations: List[List[Dict]] = []
+    # Index into conversations of each user's most recent one; logs are sorted so only that one can extend
+    last_by_user: Dict[str, int] = {}
+    # Humanloop does not guarantee ordering. sorted() consumes the generator directly,
+    # so there is only one materialized copy.
+    ordered_logs = sorted(logs, key=lambda x: x['created_at'])
+    window = hour_window * 3600
     
-    for log in sorted_logs:
+    for log in ordered_logs:
         user_id = log['user']
-        created_at = datetime.fromisoformat(str(log['created_at']).replace('Z', '+00:00'))
         
-        # Find or create conversation group
-        conv_found = False
-        for conv_id, conv_logs in conversations.items():
-            if (user_id == conv_logs[0]['user'] and 
-                (created_at - datetime.fromisoformat(str(conv_logs[-1]['created_at']).replace('Z', '+00:00'))).total_seconds() <= hour_window * 3600):
-                conversations[conv_id].append(log)
-                conv_found = True
-                break
-                
-        if not conv_found:
-            conv_id = f"conv_{len(conversations) + 1}"
-            conversations[conv_id] = [log]
+        idx = last_by_user.get(user_id)
+        if idx is not None and (log['created_at'] - conversations[idx][-1]['created_at']).total_seconds() <= window:
+            conversations[idx].append(log)
+        else:
+            last_by_user[user_id] = len(conversations)
+            conversations.append([log])
     
     print(f"Grouped into {len(conversations)} conversations")
-    return conversations
+    return {f"conv_{i + 1}": conv for i, conv in enumerate(conversations)}
 
-def write_summaries_to_file(summaries: List[str], errors: List[str]):
-    filename = f"{datetime.now().strftime('%Y-%m-%d')}_log_summary.txt"
-    
+def write_summaries_to_file(summaries: List[str], errors: List[str], filename: str):
     mode = 'a' if os.path.exists(filename) else 'w'
-    with open(filename, mode) as f:
-        if mode == 'w':
-            f.write(f"Log Analysis Report - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
-        
-        for i, summary in enumerate(summaries, 1):
-            f.write(f"Batch {i} Analysis:\n{summary}\n\n")
-            
-        if errors:
-            f.write("\nErrors:\n")
-            for error in errors:
-                f.write(f"- {error}\n")
-
-def generate_final_summary(filename: str, client) -> str:
-    with open(filename, 'r') as f:
-        content = f.read()
-
-    current_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    prompt = f"""Create a consolidated analysis report aggregating findings across all batches. Use this structure with clear spacing:
-
-LOG ANALYSIS REPORT - {current_date}
+    parts = [] if mode == 'a' else [f"Log Analysis Report - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"]
+    parts.extend(f"Batch {i} Analysis:\n{summary}\n\n" for i, summary in enumerate(summaries, 1))
+    if errors:
+        parts.append("\nErrors:\n")
+        parts.extend(f"- {error}\n" for error in errors)
+
+    with open(filename, mode, buffering=1 << 16) as f:
+        f.write(''.join(parts))
+
+_embedding_model = None
+
+_EMPTY_BRACKETS_RE = re.compile(r'[\(\[][\s,;]*[\)\]]')
+_BATCH_HEADER_RE = re.compile(r'^Batch \d+ Analysis:$')
+
+# Bullets shorter than this once log IDs are removed (e.g. "- Log ID: log_x") carry no finding to compare
+DEDUP_MIN_WORDS = 4
+
+def section_key(line: str) -> str:
+    # "### 2. User Pain Points:" and "**User pain points**" both become "user pain points"
+    return ' '.join(re.sub(r'[^a-z ]', ' ', line.lower()).split())
+
+def dedupe_summary_lines(content: str, threshold: float = 0.85) -> str:
+    # Batches often restate the same finding; drop bullets that are near-duplicates of an earlier one
+    # in the same section, moving their log IDs onto the bullet that is kept so no cited example is lost
+    global _embedding_model
+    lines = content.split('\n')
+    section = ''
+    bullet_idx = []
+    sections = []
+    texts = []
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or _BATCH_HEADER_RE.match(stripped):
+            continue
+        if not stripped.startswith(('- ', '* ', '• ')):
+            section = section_key(stripped)
+            continue
+        # Compare the findings themselves, not which log IDs they happen to cite
+        text = _EMPTY_BRACKETS_RE.sub('', _LOG_ID_RE.sub('', stripped[2:])).strip()
+        if len(text.split()) < DEDUP_MIN_WORDS:
+            continue
+        bullet_idx.append(i)
+        sections.append(section)
+        texts.append(text)
+    if len(bullet_idx) < 2:
+        return content
+
+    try:
+        import numpy as np
+        if _embedding_model is None:
+            from fastembed import TextEmbedding
+            _embedding_model = TextEmbedding("BAAI/bge-small-en-v1.5")
+        vectors = np.array(list(_embedding_model.embed(texts)))
+    except Exception as e:
+        logger.error(f"Skipping bullet dedup: {e}")
+        return content
+
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    kept: Dict[str, List[int]] = {}
+    dropped = set()
+    merged_ids = {}
+    for pos, v in enumerate(vectors):
+        # Sub-bullets already removed along with their parent must not become merge targets
+        if bullet_idx[pos] in dropped:
+            continue
+        section_kept = kept.setdefault(sections[pos], [])
+        if section_kept:
+            sims = np.dot(vectors[section_kept], v)
+            best = int(np.argmax(sims))
+            if sims[best] > threshold:
+                target = bullet_idx[section_kept[best]]
+                # A dropped bullet takes its nested sub-bullets with it
+                start = bullet_idx[pos]
+                indent = len(lines[start]) - len(lines[start].lstrip())
+                end = start + 1
+                while end < len(lines) and lines[end].strip() and len(lines[end]) - len(lines[end].lstrip()) > indent:
+                    end += 1
+                extra = merged_ids.setdefault(target, [])
+                cited = set(_LOG_ID_RE.findall(lines[target]))
+                for i in range(start, end):
+                    for log_id in _LOG_ID_RE.findall(lines[i]):
+                        if log_id not in cited and log_id not in extra:
+                            extra.append(log_id)
+                    dropped.add(i)
+                continue
+        section_kept.append(pos)
+
+    for i, extra in merged_ids.items():
+        if extra:
+            lines[i] = f"{lines[i]} ({', '.join(extra)})"
+
+    print(f"Dropped {len(dropped)} lines as near-duplicates of {len(bullet_idx)} comparable bullets")
+    return '\n'.join(line for i, line in enumerate(lines) if i not in dropped)
+
+# Static rubric for the final report. Kept byte-for-byte identical between runs and
+# above OpenAI's 1024-token prompt caching threshold, so do not interpolate anything here.
+SYSTEM_RUBRIC = """You are compiling the daily log analysis report for a customer service chat bot. You will be given the report date and the raw output of several batch analyses, each of which covered a handful of conversations. Create a consolidated analysis report aggregating findings across all batches. Use this structure with clear spacing:
+
+LOG ANALYSIS REPORT - [report date from the user message]
 
 SUCCESSFUL INTERACTIONS
 [Aggregate unique successful interactions across all batches, with log IDs]
@@ -187,17 +603,192 @@ Key guidelines:
 
 YOU MUST INCLUDE ALL SECTIONS - DO NOT SKIP ANY
 
-Content to analyze:
-{content}"""
+How the input is laid out:
+- The user message starts with a line of the form "Report date: YYYY-MM-DD". Use that date, exactly as given, in the title line of the report.
+- After a blank line comes the line "Content to analyze:", followed by the batch analyses one after another.
+- Each batch analysis starts with a line of the form "Batch N Analysis:" and runs until the next such line or the end of the message.
+- Inside a batch analysis, the text is free-form. It usually has one part per section, but the headings, numbering and bullet style vary from batch to batch.
+- Log IDs in the batch analyses have the form log_ followed by letters and digits.
+
+How the report is rendered:
+- The report is converted to a PDF by a simple line-based renderer. It reads the report one line at a time and does not interpret markdown.
+- A line written entirely in capital letters is drawn as a section heading in a larger bold font, with extra space above it.
+- A line that starts with "- " is drawn as a bullet, indented from the left margin. Long lines are wrapped to the page width, and wrapped lines keep the same indent.
+- Any other line is drawn as plain body text at the left margin.
+- Log IDs are found by their log_ prefix and drawn in a different style, so they must appear in the text exactly as they are written in the content.
+- Blank lines are kept, so they control the spacing between bullets and between sections.
+
+Formatting rules (these follow from how the renderer works, so they matter):
+- The first line of the report is the title line shown in the structure above, followed by a blank line.
+- Section headings must appear on their own line, exactly as written above, in upper case, in the order shown above, with no numbering, no markdown symbols and no trailing punctuation.
+- Do not use upper case for any line that is not a section heading or the title line.
+- Every finding is a single bullet that starts with "- " at the beginning of the line. Do not nest bullets and do not use numbered lists, asterisks, bold, italics, tables or code blocks.
+- Write each bullet as a single line of text; do not insert line breaks inside a bullet.
+- Write each log ID bare, exactly as it appears in the content, in the form log_XYZ, with no quotes or backticks around it. Never invent, shorten or reformat a log ID.
+- Put the log IDs a bullet cites in a single pair of parentheses at the end of the bullet, separated by commas, for example: (log_abc123, log_def456).
+- If a section has no findings, keep its heading and write a single bullet saying so.
+- Do not include a preamble, closing remarks, sign-off or any text outside the title line and the four sections.
+
+Spacing:
+- Leave exactly one blank line between the title line and the first section heading.
+- Put the first bullet of a section on the line directly below its heading, with no blank line in between.
+- Leave one blank line between consecutive bullets in the same section.
+- Leave two blank lines after the last bullet of a section, before the next section heading.
+- Do not end the report with blank lines after the last bullet of USER SENTIMENT SUMMARY.
+
+Layout example. This shows only the shape of the output; the bracketed text stands for your own content and must not be copied:
+
+LOG ANALYSIS REPORT - [report date]
+
+SUCCESSFUL INTERACTIONS
+- [First successful interaction finding.] (log_[id], log_[id])
+
+- [Second successful interaction finding.] (log_[id])
+
+- [Third successful interaction finding.] (log_[id], log_[id])
+
+
+USER PAIN POINTS/FRUSTRATIONS
+- [First pain point finding.] (log_[id], log_[id], log_[id])
+
+- [Second pain point finding.] (log_[id])
+
+- [Third pain point finding.] (log_[id], log_[id])
+
+
+COMMON THEMES/PATTERNS
+- [First theme or pattern.] (log_[id], log_[id])
+
+- [Second theme or pattern.] (log_[id], log_[id])
+
+- [Third theme or pattern.] (log_[id], log_[id], log_[id])
+
+
+USER SENTIMENT SUMMARY
+- [A few sentences on the overall sentiment across all batches.]"""
+
+FINAL_CONTEXT_BUDGET = int(os.getenv("FINAL_CONTEXT_BUDGET", "100000"))
+
+def iter_lines_reversed(filename: str, block_size: int = 1 << 16) -> Iterator[str]:
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        remainder = b''
+        while pos > 0:
+            read = min(block_size, pos)
+            pos -= read
+            f.seek(pos)
+            lines = (f.read(read) + remainder).split(b'\n')
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                yield line.decode()
+        yield remainder.decode()
+
+def iter_summary_blocks(filename: str) -> Iterator[Tuple[str, List[str]]]:
+    # Yields ("batch" | "errors" | "preamble", lines) newest block first; each block's lines are
+    # in reverse order, ending with its "Batch N Analysis:" or "Errors:" line
+    block = []
+    for line in iter_lines_reversed(filename):
+        block.append(line)
+        if _BATCH_HEADER_RE.match(line):
+            yield "batch", block
+            block = []
+        elif line == "Errors:":
+            yield "errors", block
+            block = []
+    if block:
+        yield "preamble", block
+
+def read_recent_summaries(filename: str, budget: int = FINAL_CONTEXT_BUDGET) -> str:
+    # Walk the file from the end and keep whole batches until the token budget runs out,
+    # so the most recent batches survive and memory stays bounded by the budget. The newest
+    # batch is always kept, cut down by lines if it alone exceeds the budget, and error lists
+    # only get whatever budget the batches leave.
+    kept = []
+    error_blocks = []
+    total_tokens = 0
+    stopped = False
+    dropped = {"batch": 0, "errors": 0, "preamble": 0}
+    for seq, (kind, block) in enumerate(iter_summary_blocks(filename)):
+        if stopped:
+            dropped[kind] += 1
+            continue
+        tokens = sum(count_tokens(line) + 1 for line in block)
+        if kind == "errors":
+            if tokens <= budget:
+                error_blocks.append((seq, block, tokens))
+            else:
+                dropped[kind] += 1
+        elif total_tokens + tokens <= budget:
+            kept.append((seq, block))
+            total_tokens += tokens
+        elif kind == "batch" and not kept:
+            lines = []
+            for line in reversed(block):
+                line_tokens = count_tokens(line) + 1
+                if total_tokens + line_tokens > budget:
+                    break
+                lines.append(line)
+                total_tokens += line_tokens
+            lines.append(f"...[truncated {len(block) - len(lines)} lines]")
+            kept.append((seq, lines[::-1]))
+        else:
+            stopped = True
+            dropped[kind] += 1
+
+    for seq, block, tokens in error_blocks:
+        if total_tokens + tokens <= budget:
+            kept.append((seq, block))
+            total_tokens += tokens
+        else:
+            dropped["errors"] += 1
+
+    lines = []
+    for seq, block in sorted(kept, key=lambda item: item[0]):
+        lines.extend(block)
+    notes = []
+    if dropped["batch"]:
+        notes.append(f"{dropped['batch']} batch{'es' if dropped['batch'] != 1 else ''}")
+    if dropped["errors"]:
+        notes.append(f"{dropped['errors']} error list{'s' if dropped['errors'] != 1 else ''}")
+    if dropped["preamble"]:
+        notes.append("the report header")
+    if notes:
+        lines.append(f"...[truncated {', '.join(notes)}]")
+    lines.reverse()
+    return '\n'.join(lines)
+
+def generate_final_summary(filename: str, client) -> str:
+    content = read_recent_summaries(filename)
+    content = dedupe_summary_lines(content)
+
+    # Day granularity keeps the prompt, and so the cache key, stable across same-day re-runs
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    user_message = f"Report date: {current_date}\n\nContent to analyze:\n{content}"
+    cache = get_llm_cache()
+    key = llm_cache_key(FINAL_MODEL, 0, SYSTEM_RUBRIC + user_message)
+    if key in cache:
+        print("Using cached final summary")
+        return cache[key]
 
     response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[{"role": "user", "content": prompt}],
+        model=FINAL_MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_RUBRIC},
+            {"role": "user", "content": user_message}
+        ],
         temperature=0
     )
-    return response.choices[0].message.content
+    final_summary = response.choices[0].message.content
+    cache.set(key, final_summary, expire=LLM_CACHE_EXPIRE)
+    return final_summary
 
 def write_to_pdf(final_summary: str, filename: str):
+    # Imported here so runs that exit before reporting don't pay reportlab's import time
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.utils import simpleSplit
+
     pdf_filename = filename
     c = canvas.Canvas(pdf_filename, pagesize=letter)
     width, height = letter
@@ -206,44 +797,29 @@ def write_to_pdf(final_summary: str, filename: str):
     line_height = 14
     section_spacing = line_height * 2
 
-    def wrap_text(text, width):
-        words = text.split()
-        lines = []
-        current_line = []
-        current_width = 0
-
-        for word in words:
-            word_width = c.stringWidth(word, "Helvetica", 11)
-            if current_width + word_width <= width:
-                current_line.append(word)
-                current_width += word_width + c.stringWidth(' ', "Helvetica", 11)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-                current_width = word_width
-
-        if current_line:
-            lines.append(' '.join(current_line))
-        return lines
+    @lru_cache(maxsize=None)
+    def w(tok):
+        return c.stringWidth(tok, "Helvetica", 11)
 
     def find_log_ids(text):
-        import re
-        matches = re.finditer(r'(log_[a-zA-Z0-9]+)', text)
-        return [(m.group(1), m.start(), m.end()) for m in matches]
+        return [(m.group(0), m.start(), m.end()) for m in _LOG_ID_RE.finditer(text)]
 
     for line in final_summary.split('\n'):
         if y < margin:
             c.showPage()
             y = height - margin
 
+        # Most lines carry no log IDs, so scan each logical line once before wrapping
+        line_has_log_ids = _LOG_ID_RE.search(line) is not None
+
         if line.isupper() and len(line) > 3:
             c.setFont("Helvetica-Bold", 14)
             y -= section_spacing
-            wrapped = wrap_text(line, width - 2*margin)
+            wrapped = simpleSplit(line, "Helvetica", 11, width - 2*margin)
         else:
             c.setFont("Helvetica", 11)
             indent = 60 if line.strip().startswith('-') else margin
-            wrapped = wrap_text(line, width - indent - margin)
+            wrapped = simpleSplit(line, "Helvetica", 11, width - indent - margin)
 
         for wrapped_line in wrapped:
             if y < margin:
@@ -253,7 +829,7 @@ def write_to_pdf(final_summary: str, filename: str):
             x = indent if line.strip().startswith('-') else margin
 
             # Handle hyperlinks for log IDs
-            log_ids = find_log_ids(wrapped_line)
+            log_ids = find_log_ids(wrapped_line) if line_has_log_ids else []
             if log_ids:
                 current_x = x
                 last_end = 0
@@ -261,7 +837,7 @@ def write_to_pdf(final_summary: str, filename: str):
                     # Draw text before log ID
                     prefix = wrapped_line[last_end:start]
                     c.drawString(current_x, y, prefix)
-                    current_x += c.stringWidth(prefix, "Helvetica", 11)
+                    current_x += w(prefix)
 
                     # Draw log ID as hyperlink
                     url = f"https://YOUR_HUMANLOOP_URL/logs?id={log_id}"  # Masked
@@ -270,10 +846,11 @@ def write_to_pdf(final_summary: str, filename: str):
                     c.drawString(current_x, y, log_text)
 
                     # Add hyperlink
-                    rect = (current_x, y - 2, current_x + c.stringWidth(log_text, "Helvetica", 11), y + 10)
+                    log_w = w(log_text)
+                    rect = (current_x, y - 2, current_x + log_w, y + 10)
                     c.linkURL(url, rect)
 
-                    current_x += c.stringWidth(log_text, "Helvetica", 11)
+                    current_x += log_w
                     last_end = end
                     c.setFillColorRGB(0, 0, 0)  # Reset to black
 
@@ -293,7 +870,20 @@ def write_to_pdf(final_summary: str, filename: str):
 
     c.save()
 
-def send_email(pdf_path: str):
+async def connect_smtp(sender: str):
+   import aiosmtplib
+
+   # Implicit TLS on 465 avoids the extra STARTTLS round trip
+   smtp = aiosmtplib.SMTP(hostname='smtp.gmail.com', port=465, use_tls=True)
+   await smtp.connect()
+   await smtp.login(sender, os.getenv('GMAIL_APP_PASSWORD'))
+   return smtp
+
+async def send_email(pdf_path: str, smtp=None):
+   from email.mime.multipart import MIMEMultipart
+   from email.mime.text import MIMEText
+   from email.mime.application import MIMEApplication
+
    sender = os.getenv("SENDER_EMAIL_ADDRESS")  
    recipient = os.getenv("RECIPIENT_EMAIL_ADDRESS")  
 
@@ -310,13 +900,32 @@ def send_email(pdf_path: str):
        pdf.add_header('Content-Disposition', 'attachment', filename=os.path.basename(pdf_path))
        msg.attach(pdf)
    
-   server = smtplib.SMTP('smtp.gmail.com', 587)
-   server.starttls()
-   server.login(sender, os.getenv('GMAIL_APP_PASSWORD'))
-   server.send_message(msg)
-   server.quit()
+   if smtp is None:
+       smtp = await connect_smtp(sender)
+   await smtp.send_message(msg)
+   await smtp.quit()
+
+async def deliver_report(final_summary: str, pdf_path: str):
+    # The SMTP handshake and login don't depend on the PDF, so run them while it renders
+    rendered, smtp = await asyncio.gather(
+        asyncio.to_thread(write_to_pdf, final_summary, pdf_path),
+        connect_smtp(os.getenv("SENDER_EMAIL_ADDRESS")),
+        return_exceptions=True
+    )
+    if isinstance(rendered, BaseException):
+        if not isinstance(smtp, BaseException):
+            await smtp.quit()
+        raise rendered
+    if isinstance(smtp, BaseException):
+        raise smtp
+    await send_email(pdf_path, smtp)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze and report on production chat logs")
+    parser.add_argument("--interactive", action="store_true",
+                        help="Call chat completions directly instead of submitting an overnight Batch API job")
+    args = parser.parse_args()
+
     filename = f"{datetime.now().strftime('%Y-%m-%d')}_log_summary"
     humanloop_client = Humanloop(
         api_key=os.getenv('HUMANLOOP_API_KEY'),
@@ -324,13 +933,16 @@ if __name__ == "__main__":
     )
     file_id = os.getenv('FILE_ID')
     
-    logs = get_production_logs(humanloop_client, file_id)
-    conversations = group_conversations(logs)
-    summaries, errors = batch_analyze(conversations)
-    write_summaries_to_file(summaries, errors)
+    fetched_at = datetime.now(timezone.utc)
+    conversations = group_conversations(iter_production_logs(humanloop_client, file_id, fetch_start_date(fetched_at)))
+    if not conversations:
+        print("\nNo production logs found, skipping report")
+        raise SystemExit(0)
+    summaries, errors, processed_log_ids = asyncio.run(batch_analyze(conversations, interactive=args.interactive))
+    write_summaries_to_file(summaries, errors, f"{filename}.txt")
+    save_state(processed_log_ids, fetch_watermark(conversations, processed_log_ids, fetched_at))
     final_summary = generate_final_summary(f"{filename}.txt", openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY')))
-    write_to_pdf(final_summary, f"{filename}.pdf")
-    send_email(f"{filename}.pdf")
+    asyncio.run(deliver_report(final_summary, f"{filename}.pdf"))
     print("\nSummaries:", json.dumps(summaries, indent=2))
     print("\nErrors:", errors)
     print("\nFinal Summary:", final_summary)